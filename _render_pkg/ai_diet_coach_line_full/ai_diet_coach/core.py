@@ -14,77 +14,116 @@ Features:
 from __future__ import annotations
 from typing import Dict, Tuple, Optional, List
 import math, statistics
+from functools import lru_cache
+from dataclasses import dataclass
 from datetime import datetime
+import numpy as np
 
 # ---------- Calculations ----------
 
+def _bmr(is_male: bool, weight_kg: float, height_cm: float, age: int) -> float:
+    # Mifflin–St Jeor; shared by calculate_bmr and _plan_kernel
+    return round(10 * weight_kg + 6.25 * height_cm - 5 * age + (5 if is_male else -161), 2)
+
+def _tdee(bmr: float, activity_idx: int) -> float:
+    return round(bmr * _ACTIVITY_FACTORS[activity_idx], 2)
+
 def calculate_bmr(sex: str, *, weight_kg: float, height_cm: float, age: int) -> float:
     s = (sex or "").lower()
     if s not in {"male", "female"}:
         raise ValueError("sex must be 'male' or 'female'")
-    base = 10 * float(weight_kg) + 6.25 * float(height_cm) - 5 * int(age)
-    base += 5 if s == "male" else -161
-    return round(base, 2)
+    return _bmr(s == "male", float(weight_kg), float(height_cm), int(age))
+
+_ACTIVITY_IDX = {"sedentary": 0, "light": 1, "moderate": 2, "active": 3, "very_active": 4}
+_ACTIVITY_FACTORS = (1.2, 1.375, 1.55, 1.725, 1.9)
+_MODE_IDX = {"cut": 0, "recomp": 1, "bulk": 2}
+_MODE_DELTA = (-500.0, 0.0, +300.0)
+
+def activity_index(activity: str) -> int:
+    i = _ACTIVITY_IDX.get(activity)
+    if i is None:
+        raise ValueError("activity must be one of: " + ", ".join(_ACTIVITY_IDX))
+    return i
 
 def activity_factor(activity: str) -> float:
-    factors = {
-        "sedentary": 1.2,
-        "light": 1.375,
-        "moderate": 1.55,
-        "active": 1.725,
-        "very_active": 1.9,
-    }
-    if activity not in factors:
-        raise ValueError("activity must be one of: " + ", ".join(factors))
-    return factors[activity]
+    return _ACTIVITY_FACTORS[activity_index(activity)]
 
 def calculate_tdee(bmr: float, activity: str) -> float:
-    return round(float(bmr) * activity_factor(activity), 2)
+    return _tdee(float(bmr), activity_index(activity))
 
-def build_plan(
-    sex: str, age: int, height_cm: float, weight_kg: float,
-    activity: str, mode: str,
-    goal_weight: float | None = None, deadline_days: int | None = None
-) -> Dict:
-    bmr = calculate_bmr(sex, weight_kg=weight_kg, height_cm=height_cm, age=age)
-    tdee = calculate_tdee(bmr, activity)
+def _plan_kernel(
+    is_male: bool, age: int, height_cm: float, weight_kg: float,
+    activity_idx: int, mode_idx: int, goal_weight: float, deadline_days: int,
+) -> Tuple[float, float, int, float, float, float, float, bool]:
+    """Scalar math of build_plan on pre-encoded inputs.
+
+    deadline_days <= 0 means no goal/deadline targeting. Returns
+    (bmr, tdee, target_kcal, delta_kcal, protein_g, fat_g, carb_g, clipped).
+    """
+    bmr = _bmr(is_male, weight_kg, height_cm, age)
+    tdee = _tdee(bmr, activity_idx)
 
     # daily delta from goal/deadline if provided
     delta_kcal = 0.0
-    mode_calc = (mode or "recomp").lower()
-    notes = []
-
-    if goal_weight is not None and deadline_days is not None and deadline_days > 0:
-        delta_kg = goal_weight - weight_kg
-        raw_daily = (delta_kg * 7700.0) / deadline_days  # 1kg ~ 7700kcal
+    clipped = False
+    if deadline_days > 0:
+        raw_daily = ((goal_weight - weight_kg) * 7700.0) / deadline_days  # 1kg ~ 7700kcal
         # cap to safe range
-        daily_change = max(min(raw_daily, 500.0), -750.0)
-        delta_kcal = daily_change
-        if abs(raw_daily - daily_change) > 1e-6:
-            notes.append("安全のため日次の増減を±750/500 kcalに制限しました。")
+        delta_kcal = max(min(raw_daily, 500.0), -750.0)
+        clipped = abs(raw_daily - delta_kcal) > 1e-6
 
     # fallback to mode presets if not using deadline targeting
     if delta_kcal == 0.0:
-        if mode_calc == "cut":
-            delta_kcal = -500.0
-        elif mode_calc == "bulk":
-            delta_kcal = +300.0
-        else:
-            delta_kcal = 0.0
+        delta_kcal = _MODE_DELTA[mode_idx]
 
     target_kcal = max(round(tdee + delta_kcal), 1200)
-    maintenance = round(tdee)
 
     # macros
-    protein_g = max(2.0 * weight_kg, 1.6 * weight_kg)
-    fat_g = max(0.6 * weight_kg, 40.0)
-    remaining = max(target_kcal - (protein_g * 4 + fat_g * 9), 100.0)
+    protein_g = 2.0 * weight_kg
+    fat_g = 0.6 * weight_kg if weight_kg > 200.0 / 3.0 else 40.0  # floor of 40g
+    remaining = max(target_kcal - (protein_g * 4.0 + fat_g * 9.0), 100.0)
     carb_g = remaining / 4.0
+    return bmr, tdee, target_kcal, delta_kcal, protein_g, fat_g, carb_g, clipped
+
+def build_plan(
+    sex: str, age: int, height_cm: float, weight_kg: float,
+    activity: str, mode: str,
+    goal_weight: float | None = None, deadline_days: int | None = None
+) -> Dict:
+    """Build a plan; results are memoized per (quantized) profile."""
+    plan = _build_plan_cached(
+        sex, int(age), round(float(height_cm), 2), round(float(weight_kg), 2),
+        activity, mode,
+        round(float(goal_weight), 2) if goal_weight is not None else None,
+        int(deadline_days) if deadline_days is not None else None,
+    )
+    # copy so callers can't mutate the cached entry
+    return {**plan, "notes": list(plan["notes"])}
+
+@lru_cache(maxsize=4096)
+def _build_plan_cached(
+    sex: str, age: int, height_cm: float, weight_kg: float,
+    activity: str, mode: str,
+    goal_weight: float | None, deadline_days: int | None,
+) -> Dict:
+    s = (sex or "").lower()
+    if s not in {"male", "female"}:
+        raise ValueError("sex must be 'male' or 'female'")
+    activity_idx = activity_index(activity)
+    mode_calc = (mode or "recomp").lower()
+    targeting = goal_weight is not None and deadline_days is not None and deadline_days > 0
+
+    bmr, tdee, target_kcal, delta_kcal, protein_g, fat_g, carb_g, clipped = _plan_kernel(
+        s == "male", age, height_cm, weight_kg,
+        activity_idx, _MODE_IDX.get(mode_calc, _MODE_IDX["recomp"]),
+        goal_weight if targeting else 0.0, deadline_days if targeting else 0,
+    )
+    notes = ("安全のため日次の増減を±750/500 kcalに制限しました。",) if clipped else ()
 
     return {
         "bmr": bmr,
         "tdee": tdee,
-        "maintenance_kcal": maintenance,
+        "maintenance_kcal": round(tdee),
         "target_kcal": target_kcal,
         "delta_kcal": round(delta_kcal),
         "mode": mode_calc,
@@ -96,16 +135,32 @@ def build_plan(
 
 # ---------- Weight logging & suggestions ----------
 
-def suggest_after_log(history: List[Dict], mode: str, recent_window: int = 7) -> str:
+@dataclass(slots=True)
+class HistoryEntry:
+    """One weight log, timestamped in epoch seconds; date is derived on access."""
+    ts: int
+    weight: float
+
+    @classmethod
+    def at(cls, date: datetime, weight: float) -> HistoryEntry:
+        return cls(int(date.timestamp()), weight)
+
+    @property
+    def date(self) -> datetime:
+        return datetime.fromtimestamp(self.ts)
+
+def suggest_after_log(history: List[HistoryEntry], mode: str, recent_window: int = 7) -> str:
     """Simple dynamic suggestion after a new weight log."""
     if not history:
         return "ログを続けましょう。まずは1〜2週間、同じ条件で測定を。"
     mode = (mode or "recomp").lower()
-    # use last N
-    last = history[-recent_window:]
-    if len(last) >= 2:
-        delta = last[-1]["weight"] - last[0]["weight"]
-        days = (last[-1]["date"] - last[0]["date"]).days or 1
+    # use last N (by index, without slicing)
+    n = len(history)
+    start = max(0, n - recent_window)
+    if n - start >= 2:
+        h0, h1 = history[start], history[-1]
+        delta = h1.weight - h0.weight
+        days = max((h1.ts - h0.ts) // 86400, 1)
         daily_change = delta / days
     else:
         daily_change = 0.0
@@ -130,29 +185,45 @@ def suggest_after_log(history: List[Dict], mode: str, recent_window: int = 7) ->
         else:
             return "維持期でも上下はあります。1〜2週間の平均で見ていきましょう。"
 
-def summarise_history(history: List[Dict], days: int = 30) -> Dict:
-    if not history:
-        return {"count": 0}
-    # last N days
-    cutoff = history[-1]["date"]
-    window = [x for x in history if (cutoff - x["date"]).days <= days]
-    if not window:
-        return {"count": 0}
-    weights = [x["weight"] for x in window]
-    delta = weights[-1] - weights[0]
-    avg = round(sum(weights) / len(weights), 2)
+def _history_arrays(history: List[HistoryEntry]) -> Tuple[np.ndarray, np.ndarray]:
+    """(epoch seconds, weights) as float64 arrays, in history order."""
+    n = len(history)
+    dates = np.fromiter((x.ts for x in history), dtype=np.float64, count=n)
+    weights = np.fromiter((x.weight for x in history), dtype=np.float64, count=n)
+    return dates, weights
+
+def _summarise_window(history: List[HistoryEntry], dates: np.ndarray, weights: np.ndarray,
+                      offset: int, days: int) -> Dict:
+    # dates/weights cover history[offset:]; history is chronological,
+    # so the last-N-days window is a suffix
+    start = int(np.searchsorted(dates, dates[-1] - (days + 1) * 86400.0, side="right"))
+    w = weights[start:]
+    delta = float(w[-1] - w[0])
     trend = "↘" if delta < -0.3 else ("↗" if delta > 0.3 else "→")
     return {
-        "count": len(window),
-        "from": window[0]["date"].date().isoformat(),
-        "to": window[-1]["date"].date().isoformat(),
-        "start": round(weights[0], 2),
-        "end": round(weights[-1], 2),
-        "avg": avg,
+        "count": len(w),
+        "from": history[offset + start].date.date().isoformat(),
+        "to": history[-1].date.date().isoformat(),
+        "start": round(float(w[0]), 2),
+        "end": round(float(w[-1]), 2),
+        "avg": round(float(w.mean()), 2),
         "delta": round(delta, 2),
         "trend": trend,
     }
 
+def summarise_history(history: List[HistoryEntry], days: int = 30) -> Dict:
+    return summarise_history_multi(history, (days,))[days]
+
+def summarise_history_multi(history: List[HistoryEntry], day_windows: Tuple[int, ...]) -> Dict[int, Dict]:
+    """summarise_history for several windows, sharing one pass over history."""
+    if not history:
+        return {d: {"count": 0} for d in day_windows}
+    dates, weights = _history_arrays(history)
+    # narrower windows are suffixes of the widest one
+    offset = int(np.searchsorted(dates, dates[-1] - (max(day_windows) + 1) * 86400.0, side="right"))
+    dates, weights = dates[offset:], weights[offset:]
+    return {d: _summarise_window(history, dates, weights, offset, d) for d in day_windows}
+
 # ---------- Profile helpers ----------
 
 def progress_bar(done: int, total: int, width: int = 10) -> str:
@@ -165,3 +236,4 @@ def validate_profile(p: Dict) -> None:
     missing = [k for k in required if k not in p]
     if missing:
         raise ValueError("missing fields: " + ", ".join(missing))
+    activity_index(p["activity"])
@@ -1,22 +1,27 @@
 
 from __future__ import annotations
-import os, json
+import os, re, json, asyncio, logging, weakref
+import orjson
 from pathlib import Path
+from collections import OrderedDict
 from datetime import datetime
+from typing import Any, Callable
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from ai_diet_coach.core import (
-    build_plan, progress_bar, validate_profile,
-    summarise_history, suggest_after_log,
+    HistoryEntry, build_plan, progress_bar, validate_profile,
+    summarise_history_multi, suggest_after_log,
 )
 
 from linebot import LineBotApi, WebhookParser
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 
+log = logging.getLogger(__name__)
+
 CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET", "")
 CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "")
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN) if CHANNEL_ACCESS_TOKEN else None
 parser = WebhookParser(CHANNEL_SECRET) if CHANNEL_SECRET else None
 
@@ -33,6 +38,42 @@ ONBOARD_KEYS = [
     ("deadline_days", "期限(日)を入力（任意。スキップは 'skip'）"),
 ]
 
+# onboarding progress only ever takes these values
+_BARS = tuple(progress_bar(i, len(ONBOARD_KEYS)) for i in range(len(ONBOARD_KEYS) + 1))
+
+# Onboarding answer parsers; a ValueError carries the message sent back to the user.
+
+def _choice(options: set[str], msg: str) -> Callable[[str], str]:
+    def parse(v: str) -> str:
+        v = v.lower()
+        if v not in options:
+            raise ValueError(msg)
+        return v
+    return parse
+
+def _number(conv: Callable[[str], Any], msg: str) -> Callable[[str], Any]:
+    def parse(v: str) -> Any:
+        try:
+            return conv(v)
+        except ValueError:
+            raise ValueError(msg) from None
+    return parse
+
+def _skippable(parse: Callable[[str], Any]) -> Callable[[str], Any]:
+    return lambda v: None if v.lower() == "skip" else parse(v)
+
+ONBOARD_PARSERS: dict[str, Callable[[str], Any]] = {
+    "sex": _choice({"male", "female"}, "male/female を入力してください"),
+    "age": _number(int, "年齢は整数で入力してください"),
+    "height_cm": _number(float, "身長は数値で入力してください"),
+    "weight_kg": _number(float, "体重は数値で入力してください"),
+    "activity": _choice({"sedentary", "light", "moderate", "active", "very_active"},
+                        "sedentary/light/moderate/active/very_active から選択してください"),
+    "mode": _choice({"cut", "recomp", "bulk"}, "cut/recomp/bulk から選択してください"),
+    "goal_weight": _skippable(_number(float, "目標体重は数値か 'skip' で入力してください")),
+    "deadline_days": _skippable(_number(int, "期限は整数か 'skip' で入力してください")),
+}
+
 HELP = (
     "使い方:\n"
     "・start … オンボーディング開始（進捗バー表示）\n"
@@ -47,31 +88,123 @@ HELP = (
 
 def _p(uid: str) -> Path: return DATA_DIR / f"{uid}.json"
 
-def load_state(uid: str) -> dict:
-    p = _p(uid)
-    if not p.exists(): return {"profile": {}, "history": [], "stage": "idle", "onboard_idx": 0}
+# In-memory state cache; writes are debounced and flushed in the background.
+STATE_CACHE_SIZE = 1024
+FLUSH_DELAY = 0.5  # seconds
+STATE_CACHE: OrderedDict[str, dict] = OrderedDict()
+_DIRTY: dict[str, dict] = {}  # uid -> state not yet written to disk
+_FLUSH_TASKS: dict[str, asyncio.Task] = {}
+_WAITING: set[str] = set()  # uids whose flush task is still in its delay
+
+def _cache_put(uid: str, state: dict) -> None:
+    STATE_CACHE[uid] = state
+    STATE_CACHE.move_to_end(uid)
+    if len(STATE_CACHE) > STATE_CACHE_SIZE:
+        STATE_CACHE.popitem(last=False)
+
+async def _read_state(uid: str) -> dict:
+    # file I/O runs in a worker thread so the event loop isn't blocked;
+    # a missing file lands in the except branch like any unreadable one
     try:
-        raw = json.loads(p.read_text("utf-8"))
-        # parse dates
-        for x in raw.get("history", []):
-            if isinstance(x.get("date"), str):
-                x["date"] = datetime.fromisoformat(x["date"])
+        raw = orjson.loads(await asyncio.to_thread(_p(uid).read_bytes))
+        # entries store epoch seconds; only files written before "ts"
+        # existed need their ISO dates parsed
+        raw["history"] = [
+            HistoryEntry(x["ts"], x["weight"]) if "ts" in x
+            else HistoryEntry.at(datetime.fromisoformat(x["date"]), x["weight"])
+            for x in raw.get("history", [])
+        ]
         return raw
     except Exception:
         return {"profile": {}, "history": [], "stage": "idle", "onboard_idx": 0}
 
-def save_state(uid: str, state: dict) -> None:
-    # stringify dates
-    dump = {"profile": state.get("profile", {}), "history": [], "stage": state.get("stage", "idle"), "onboard_idx": state.get("onboard_idx", 0)}
-    for x in state.get("history", []):
-        dump["history"].append({"date": (x["date"].isoformat() if isinstance(x["date"], datetime) else str(x["date"])), "weight": x["weight"]})
-    _p(uid).write_text(json.dumps(dump, ensure_ascii=False, indent=2), "utf-8")
+async def _write_state(uid: str, state: dict) -> None:
+    # orjson serializes HistoryEntry dataclasses natively
+    dump = {
+        "profile": state.get("profile", {}),
+        "history": state.get("history", []),
+        "stage": state.get("stage", "idle"),
+        "onboard_idx": state.get("onboard_idx", 0),
+    }
+    data = orjson.dumps(dump, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    await asyncio.to_thread(_p(uid).write_bytes, data)
+
+async def _flush_dirty(uid: str) -> None:
+    # saves made while writing are picked up by the next pass,
+    # so there is only ever one writer per uid
+    while (state := _DIRTY.pop(uid, None)) is not None:
+        try:
+            await _write_state(uid, state)
+        except Exception:
+            log.exception("failed to write state for %s", uid)
+            # keep it pending for the next flush unless a newer save replaced it
+            _DIRTY.setdefault(uid, state)
+            return
+
+async def _flush_later(uid: str) -> None:
+    try:
+        try:
+            await asyncio.sleep(FLUSH_DELAY)
+        except asyncio.CancelledError:
+            pass  # flush_states cut the delay short; write now
+        finally:
+            _WAITING.discard(uid)
+        await _flush_dirty(uid)
+    finally:
+        _FLUSH_TASKS.pop(uid, None)
+
+def _cached_state(uid: str) -> dict | None:
+    state = STATE_CACHE.get(uid)
+    if state is None:
+        # evicted from the cache but not flushed yet
+        state = _DIRTY.get(uid)
+    if state is not None:
+        _cache_put(uid, state)
+    return state
+
+async def load_state(uid: str) -> dict:
+    state = _cached_state(uid)
+    if state is None:
+        loaded = await _read_state(uid)
+        # another request may have loaded or saved this uid during the read;
+        # keep that copy so its changes aren't overwritten
+        state = _cached_state(uid)
+        if state is None:
+            state = loaded
+            _cache_put(uid, state)
+    return state
+
+async def save_state(uid: str, state: dict) -> None:
+    _cache_put(uid, state)
+    _DIRTY[uid] = state
+    if uid not in _FLUSH_TASKS:
+        _WAITING.add(uid)
+        _FLUSH_TASKS[uid] = asyncio.create_task(_flush_later(uid))
+
+@app.on_event("shutdown")
+async def flush_states() -> None:
+    # only interrupt tasks that are still sleeping, never one mid-write
+    for uid in _WAITING:
+        _FLUSH_TASKS[uid].cancel()
+    await asyncio.gather(*_FLUSH_TASKS.values(), return_exceptions=True)
+    # a task cancelled before it first ran never reaches its write loop
+    _FLUSH_TASKS.clear()
+    _WAITING.clear()
+    for uid in list(_DIRTY):
+        await _flush_dirty(uid)
 
 def reply(token: str, text: str) -> None:
     if not line_bot_api:
         raise HTTPException(status_code=500, detail="LINE credentials not set")
     line_bot_api.reply_message(token, TextSendMessage(text=text))
 
+_PLAN_TPL = (
+    "📊 プラン\n"
+    "BMR: {bmr} kcal / TDEE: {tdee} kcal\n"
+    "目標: {target_kcal} kcal（維持 {maintenance_kcal} kcal, Δ {delta_kcal}）\n"
+    "マクロ: P {protein_g}g / F {fat_g}g / C {carb_g}g"
+)
+
 def format_plan(profile: dict) -> str:
     goal_w = profile.get("goal_weight")
     deadline = profile.get("deadline_days")
@@ -81,24 +214,173 @@ def format_plan(profile: dict) -> str:
         float(goal_w) if goal_w not in (None, "", "skip") else None,
         int(deadline) if deadline not in (None, "", "skip") else None,
     )
-    lines = [
-        "📊 プラン",
-        f"BMR: {plan['bmr']} kcal / TDEE: {plan['tdee']} kcal",
-        f"目標: {plan['target_kcal']} kcal（維持 {plan['maintenance_kcal']} kcal, Δ {plan['delta_kcal']}）",
-        f"マクロ: P {plan['protein_g']}g / F {plan['fat_g']}g / C {plan['carb_g']}g",
-    ]
+    body = _PLAN_TPL.format_map(plan)
     if plan["notes"]:
-        lines.append("Note: " + " ".join(plan["notes"]))
-    lines.append("※推定値です。医療上の助言ではありません。")
-    return "\n".join(lines)
+        body += "\nNote: " + " ".join(plan["notes"])
+    return body + "\n※推定値です。医療上の助言ではありません。"
+
+_GUIDE = {
+    "cut": "🍽 ガイド(cut): 体重×2gのタンパク質、脂質は体重×0.6g目安、残り炭水化物。就寝前の間食は控えめに。NEATを確保。",
+    "bulk": "🍽 ガイド(bulk): 体重×2gのタンパク質、炭水化物はトレ前後を厚めに。脂質は控えめ〜中庸。週+0.25〜0.5kg以内を目安。",
+    "recomp": "🍽 ガイド(recomp): Pを十分に確保しつつ、日々の活動量と睡眠を最適化。週あたり±0.25kgに収まるよう微調整。",
+}
 
 def guide_text(mode: str) -> str:
-    m = (mode or "recomp").lower()
-    if m == "cut":
-        return "🍽 ガイド(cut): 体重×2gのタンパク質、脂質は体重×0.6g目安、残り炭水化物。就寝前の間食は控えめに。NEATを確保。"
-    if m == "bulk":
-        return "🍽 ガイド(bulk): 体重×2gのタンパク質、炭水化物はトレ前後を厚めに。脂質は控えめ〜中庸。週+0.25〜0.5kg以内を目安。"
-    return "🍽 ガイド(recomp): Pを十分に確保しつつ、日々の活動量と睡眠を最適化。週あたり±0.25kgに収まるよう微調整。"
+    return _GUIDE.get((mode or "recomp").lower(), _GUIDE["recomp"])
+
+# ---------- Commands ----------
+
+_LOG_RE = re.compile(r"^log\s+(-?\d+(?:\.\d+)?)\s*$", re.I)
+_PROFILE_SET_RE = re.compile(r"^profile\s+set\s+(\w+)\s+(\S+)\s*$", re.I)
+# Each handler is a coroutine taking (ev, state, profile, text) and returning the reply text.
+
+async def _cmd_help(ev, state: dict, profile: dict, text: str) -> str:
+    return HELP
+
+async def _cmd_reset(ev, state: dict, profile: dict, text: str) -> str:
+    await save_state(ev.source.user_id, {"profile": {}, "history": [], "stage": "idle", "onboard_idx": 0})
+    return "状態を初期化しました。'start' でオンボーディングを開始できます。"
+
+async def _cmd_start(ev, state: dict, profile: dict, text: str) -> str:
+    state["stage"] = "onboarding"
+    state["onboard_idx"] = 0
+    # ask first
+    key, q = ONBOARD_KEYS[state["onboard_idx"]]
+    pb = _BARS[0]
+    await save_state(ev.source.user_id, state)
+    return f"オンボーディングを開始します。\n{pb}\n{q}"
+
+async def _cmd_plan(ev, state: dict, profile: dict, text: str) -> str:
+    try:
+        validate_profile(profile)
+        return format_plan(profile)
+    except Exception as e:
+        return f"プロフィールが未完了です: {e}\n'start' で設定してください。"
+
+async def _cmd_log(ev, state: dict, profile: dict, text: str) -> str:
+    m = _LOG_RE.match(text)
+    if not m:
+        return "ログに失敗: 体重を数値で入力してください\n例: log 65.2"
+    w = float(m.group(1))
+    state["history"] = state.get("history", [])
+    state["history"].append(HistoryEntry.at(datetime.now(), round(w, 2)))
+    await save_state(ev.source.user_id, state)
+    # suggestion (core only reads history, so pass it as is)
+    s = suggest_after_log(state["history"], profile.get("mode", "recomp"))
+    return f"記録しました: {w} kg\n{s}"
+
+async def _cmd_history(ev, state: dict, profile: dict, text: str) -> str:
+    hist = state.get("history", [])
+    if not hist:
+        return "まだ体重履歴がありません。'log 65.2' のように記録してください。"
+    sums = summarise_history_multi(hist, (7, 30))
+    s7, s30 = sums[7], sums[30]
+    msg = ["📈 履歴サマリ"]
+    if s7.get("count", 0) > 0:
+        msg.append(f"7日: {s7['from']}→{s7['to']} ({s7['trend']})  平均 {s7['avg']}kg  変化 {s7['delta']}kg")
+    if s30.get("count", 0) > 0:
+        msg.append(f"30日: {s30['from']}→{s30['to']} ({s30['trend']}) 平均 {s30['avg']}kg  変化 {s30['delta']}kg")
+    return "\n".join(msg)
+
+async def _cmd_guide(ev, state: dict, profile: dict, text: str) -> str:
+    if not profile.get("mode"):
+        return "まずは 'start' でプロフィールを設定してください。"
+    return guide_text(profile.get("mode"))
+
+async def _cmd_profile_show(ev, state: dict, profile: dict, text: str) -> str:
+    return f"プロフィール: {json.dumps(profile, ensure_ascii=False)}"
+
+_PROFILE_SET_USAGE = "例: profile set activity active\n    profile set goal_weight 62"
+
+async def _cmd_profile_set(ev, state: dict, profile: dict, text: str) -> str:
+    # e.g. profile set activity active
+    m = _PROFILE_SET_RE.match(text)
+    if not m:
+        return _PROFILE_SET_USAGE
+    key, value = m.groups()
+    try:
+        if key in {"age"}: value = int(value)
+        elif key in {"height_cm", "weight_kg", "goal_weight"}: value = float(value)
+    except ValueError:
+        return _PROFILE_SET_USAGE
+    state["profile"][key] = value
+    await save_state(ev.source.user_id, state)
+    return f"更新しました: {key} = {value}"
+
+EXACT_CMDS = {
+    "help": _cmd_help, "ヘルプ": _cmd_help,
+    "reset": _cmd_reset, "リセット": _cmd_reset,
+    "start": _cmd_start, "開始": _cmd_start,
+    "plan": _cmd_plan,
+    "history": _cmd_history,
+    "guide": _cmd_guide,
+}
+
+PREFIX_CMDS = (
+    ("log ", _cmd_log),
+    ("profile show", _cmd_profile_show),
+    ("profile set ", _cmd_profile_set),
+)
+
+def _find_cmd(low: str):
+    fn = EXACT_CMDS.get(low)
+    if fn is None:
+        fn = next((f for p, f in PREFIX_CMDS if low.startswith(p)), None)
+    return fn
+
+# One lock per user, held from load_state to the reply, so two messages from
+# the same user can't interleave and overwrite each other's changes.
+_USER_LOCKS: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+
+def _user_lock(uid: str) -> asyncio.Lock:
+    lock = _USER_LOCKS.get(uid)
+    if lock is None:
+        lock = _USER_LOCKS[uid] = asyncio.Lock()
+    return lock
+
+async def handle_text(ev) -> str:
+    """Handle one text message and return the reply text."""
+    uid = ev.source.user_id
+    text = (ev.message.text or "").strip()
+    state = await load_state(uid)
+    profile = state.get("profile", {})
+
+    # Commands
+    fn = _find_cmd(text.lower())
+    if fn is not None:
+        return await fn(ev, state, profile, text)
+
+    # Onboarding flow
+    if state.get("stage") == "onboarding":
+        idx = state.get("onboard_idx", 0)
+        key, prompt = ONBOARD_KEYS[idx]
+        val = text.strip()
+        try:
+            state["profile"][key] = ONBOARD_PARSERS[key](val)
+        except ValueError as e:
+            return str(e)
+
+        idx += 1
+        state["onboard_idx"] = idx
+        done = min(idx, len(ONBOARD_KEYS))
+        if idx >= len(ONBOARD_KEYS):
+            # finished
+            state["stage"] = "idle"
+            await save_state(uid, state)
+            # show plan
+            try:
+                validate_profile(state["profile"])
+                pb = _BARS[done]
+                return f"オンボーディング完了！\n{pb}\n\n" + format_plan(state["profile"])
+            except Exception as e:
+                return f"設定に不足があります: {e}"
+        pb = _BARS[done]
+        qkey, qtext = ONBOARD_KEYS[idx]
+        await save_state(uid, state)
+        return f"{pb}\n{qtext}"
+
+    # Fallback
+    return "コマンドが見つかりません。'help' を送って使い方を確認してください。"
 
 @app.post("/callback")
 async def callback(request: Request):
@@ -111,156 +393,19 @@ async def callback(request: Request):
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid signature/body")
 
+    # replies are sent together once every event has been handled
+    replies: list[tuple[str, str]] = []
     for ev in events:
         if isinstance(ev, MessageEvent) and isinstance(ev.message, TextMessage):
-            uid = ev.source.user_id
-            text = (ev.message.text or "").strip()
-            state = load_state(uid)
-            profile = state.get("profile", {})
-
-            # Commands
-            low = text.lower()
-            if low in {"help", "ヘルプ"}:
-                reply(ev.reply_token, HELP); continue
-
-            if low in {"reset", "リセット"}:
-                state = {"profile": {}, "history": [], "stage": "idle", "onboard_idx": 0}
-                save_state(uid, state)
-                reply(ev.reply_token, "状態を初期化しました。'start' でオンボーディングを開始できます。"); continue
-
-            if low in {"start", "開始"}:
-                state["stage"] = "onboarding"
-                state["onboard_idx"] = 0
-                # ask first
-                key, q = ONBOARD_KEYS[state["onboard_idx"]]
-                pb = progress_bar(0, len(ONBOARD_KEYS))
-                save_state(uid, state)
-                reply(ev.reply_token, f"オンボーディングを開始します。\n{pb}\n{q}")
-                continue
-
-            if low == "plan":
+            async with _user_lock(ev.source.user_id):
                 try:
-                    validate_profile(profile)
-                    reply(ev.reply_token, format_plan(profile))
-                except Exception as e:
-                    reply(ev.reply_token, f"プロフィールが未完了です: {e}\n'start' で設定してください。")
-                continue
+                    msg = await handle_text(ev)
+                except Exception:
+                    # one bad event must not cost the others their replies
+                    log.exception("failed to handle message from %s", ev.source.user_id)
+                    msg = "エラーが発生しました。時間をおいて再度お試しください。"
+            replies.append((ev.reply_token, msg))
 
-            if low.startswith("log "):
-                try:
-                    w = float(low.split()[1])
-                    state["history"] = state.get("history", [])
-                    state["history"].append({"date": datetime.now(), "weight": round(w, 2)})
-                    save_state(uid, state)
-                    # suggestion
-                    hist = state["history"]
-                    # build lightweight for core
-                    simple_hist = [{"date": h["date"], "weight": h["weight"]} for h in hist]
-                    s = suggest_after_log(simple_hist, profile.get("mode", "recomp"))
-                    reply(ev.reply_token, f"記録しました: {w} kg\n{s}")
-                except Exception as e:
-                    reply(ev.reply_token, f"ログに失敗: {e}\n例: log 65.2")
-                continue
-
-            if low == "history":
-                hist = state.get("history", [])
-                if not hist:
-                    reply(ev.reply_token, "まだ体重履歴がありません。'log 65.2' のように記録してください。")
-                else:
-                    # Convert for core summary
-                    simple = [{"date": h["date"], "weight": h["weight"]} for h in hist]
-                    s7 = summarise_history(simple, days=7)
-                    s30 = summarise_history(simple, days=30)
-                    msg = ["📈 履歴サマリ"]
-                    if s7.get("count", 0) > 0:
-                        msg.append(f"7日: {s7['from']}→{s7['to']} ({s7['trend']})  平均 {s7['avg']}kg  変化 {s7['delta']}kg")
-                    if s30.get("count", 0) > 0:
-                        msg.append(f"30日: {s30['from']}→{s30['to']} ({s30['trend']}) 平均 {s30['avg']}kg  変化 {s30['delta']}kg")
-                    reply(ev.reply_token, "\n".join(msg))
-                continue
-
-            if low == "guide":
-                if not profile.get("mode"):
-                    reply(ev.reply_token, "まずは 'start' でプロフィールを設定してください。")
-                else:
-                    reply(ev.reply_token, guide_text(profile.get("mode")))
-                continue
-
-            if low.startswith("profile show"):
-                reply(ev.reply_token, f"プロフィール: {json.dumps(profile, ensure_ascii=False)}")
-                continue
-
-            if low.startswith("profile set "):
-                # e.g. profile set activity active
-                parts = text.split()
-                try:
-                    key, value = parts[2], parts[3]
-                    if key in {"age"}: value = int(value)
-                    elif key in {"height_cm", "weight_kg", "goal_weight"}: value = float(value)
-                    state["profile"][key] = value
-                    save_state(uid, state)
-                    reply(ev.reply_token, f"更新しました: {key} = {value}")
-                except Exception as e:
-                    reply(ev.reply_token, "例: profile set activity active\n    profile set goal_weight 62")
-                continue
-
-            # Onboarding flow
-            if state.get("stage") == "onboarding":
-                idx = state.get("onboard_idx", 0)
-                key, prompt = ONBOARD_KEYS[idx]
-                val = text.strip()
-                if key == "sex":
-                    if val.lower() not in {"male", "female"}:
-                        reply(ev.reply_token, "male/female を入力してください"); continue
-                    state["profile"]["sex"] = val.lower()
-                elif key == "age":
-                    state["profile"]["age"] = int(val)
-                elif key == "height_cm":
-                    state["profile"]["height_cm"] = float(val)
-                elif key == "weight_kg":
-                    state["profile"]["weight_kg"] = float(val)
-                elif key == "activity":
-                    if val not in {"sedentary", "light", "moderate", "active", "very_active"}:
-                        reply(ev.reply_token, "sedentary/light/moderate/active/very_active から選択してください"); continue
-                    state["profile"]["activity"] = val
-                elif key == "mode":
-                    if val.lower() not in {"cut", "recomp", "bulk"}:
-                        reply(ev.reply_token, "cut/recomp/bulk から選択してください"); continue
-                    state["profile"]["mode"] = val.lower()
-                elif key == "goal_weight":
-                    if val.lower() == "skip":
-                        state["profile"]["goal_weight"] = None
-                    else:
-                        state["profile"]["goal_weight"] = float(val)
-                elif key == "deadline_days":
-                    if val.lower() == "skip":
-                        state["profile"]["deadline_days"] = None
-                    else:
-                        state["profile"]["deadline_days"] = int(val)
-
-                idx += 1
-                state["onboard_idx"] = idx
-                done = min(idx, len(ONBOARD_KEYS))
-                if idx >= len(ONBOARD_KEYS):
-                    # finished
-                    state["stage"] = "idle"
-                    save_state(uid, state)
-                    # show plan
-                    try:
-                        validate_profile(state["profile"])
-                        pb = progress_bar(done, len(ONBOARD_KEYS))
-                        msg = f"オンボーディング完了！\n{pb}\n\n" + format_plan(state["profile"])
-                    except Exception as e:
-                        msg = f"設定に不足があります: {e}"
-                    reply(ev.reply_token, msg)
-                else:
-                    pb = progress_bar(done, len(ONBOARD_KEYS))
-                    qkey, qtext = ONBOARD_KEYS[idx]
-                    save_state(uid, state)
-                    reply(ev.reply_token, f"{pb}\n{qtext}")
-                continue
-
-            # Fallback
-            reply(ev.reply_token, "コマンドが見つかりません。'help' を送って使い方を確認してください。")
-
-    return JSONResponse({"status": "ok"})
+    # reply_message is a blocking HTTP call; run them concurrently off the loop
+    await asyncio.gather(*(asyncio.to_thread(reply, token, msg) for token, msg in replies))
+    return {"status": "ok"}